@@ -6,13 +6,22 @@ from transformerx.layers.masks.core import BaseMask
 
 
 class TestPaddingMask:
-    # def test_valid_lengths(self):
-    #     scores = tf.constant([[1, 2, 3, 0], [4, 5, 0, 0]], dtype=tf.float32)
-    #     valid_lens = tf.constant([3, 2])
-    #     padding_mask = PaddingMask()
-    #     masked = padding_mask(scores=scores, valid_lens=valid_lens)
-    #     expected = tf.constant([[1, 2, 3, -1e9], [4, 5, -1e9, -1e9]])
-    #     assert tf.reduce_all(tf.equal(masked, expected))
+    def test_valid_lengths(self):
+        scores = tf.constant([[1, 2, 3, 0], [4, 5, 0, 0]], dtype=tf.float32)
+        valid_lens = tf.constant([3, 2])
+        padding_mask = PaddingMask()
+        masked = padding_mask(scores=scores, valid_lens=valid_lens)
+        expected = tf.constant([[1, 2, 3, -1e9], [4, 5, -1e9, -1e9]])
+        assert tf.reduce_all(tf.equal(masked, expected))
+
+    def test_valid_lengths_multihead(self):
+        scores = tf.zeros((2, 4, 3, 5))
+        valid_lens = tf.constant([3, 5])
+        masked = PaddingMask()(scores=scores, valid_lens=valid_lens)
+        assert masked.shape == scores.shape
+        assert tf.reduce_all(masked[0, ..., 3:] == -1e9)
+        assert tf.reduce_all(masked[0, ..., :3] == 0)
+        assert tf.reduce_all(masked[1] == 0)
 
     def test_padding_value_0(self):
         scores = tf.constant([[1, 2, 3, 0], [4, 5, 0, 0]], dtype=tf.float32)
@@ -132,3 +132,166 @@ class TestDotProductAttention:
 
         assert output.shape == values.shape, "Output shape mismatch"
         assert attention_weights.shape == (2, 2, 2), "Attention weights shape mismatch"
+
+    def test_causal_masking_zeroes_future_positions(self):
+        x = tf.random.uniform((2, 4, 6))
+        _, attention_weights = DotProductAttention(causal_mask=True)(x, x, x)
+        upper = 1 - tf.linalg.band_part(tf.ones((4, 4)), -1, 0)
+        assert tf.reduce_all(attention_weights * upper == 0)
+        np.testing.assert_allclose(tf.reduce_sum(attention_weights, axis=-1), 1.0, rtol=1e-6)
+
+    def test_jit_compile(self):
+        x = tf.random.uniform((2, 3, 5, 4))
+        eager_output, eager_weights = DotProductAttention(causal_mask=True)(x, x, x)
+        jit_output, jit_weights = DotProductAttention(causal_mask=True, jit_compile=True)(
+            x, x, x
+        )
+        np.testing.assert_allclose(jit_output, eager_output, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(jit_weights, eager_weights, rtol=1e-5, atol=1e-6)
+
+    def test_mixed_precision(self):
+        x = tf.random.uniform((2, 3, 5, 8))
+        attention = DotProductAttention(causal_mask=True, dtype="mixed_bfloat16")
+        output, attention_weights = attention(x, x, x)
+        assert output.dtype == tf.bfloat16
+        assert attention_weights.dtype == tf.float32
+        np.testing.assert_allclose(tf.reduce_sum(attention_weights, axis=-1), 1.0, rtol=1e-6)
+
+    def test_masks_are_created_once(self):
+        attention = DotProductAttention(causal_mask=True, padding_mask=True)
+        look_ahead_mask = attention.look_ahead_mask
+        padding_mask = attention.padding_mask_layer
+        x = tf.random.uniform((2, 4, 6))
+        attention(x, x, x)
+        attention(x, x, x)
+        assert attention.look_ahead_mask is look_ahead_mask
+        assert attention.padding_mask_layer is padding_mask
+        assert DotProductAttention().look_ahead_mask is None
+
+    def test_quantized_attention(self):
+        x = tf.random.normal((2, 4, 10, 16))
+        output, attention_weights = DotProductAttention()(x, x, x)
+        quantized_output, quantized_weights = DotProductAttention(
+            quantized_attention=True
+        )(x, x, x)
+        assert quantized_output.shape == output.shape
+        assert quantized_output.dtype == output.dtype
+        np.testing.assert_allclose(quantized_weights, attention_weights, atol=5e-2)
+        np.testing.assert_allclose(quantized_output, output, atol=1e-1)
+
+    def test_attention_mask(self):
+        x = tf.random.uniform((2, 3, 4))
+        attention_mask = tf.constant([[1, 1, 0], [1, 0, 0]])
+        _, attention_weights = DotProductAttention()(x, x, x, attention_mask)
+        assert tf.reduce_all(attention_weights[0, :, 2:] == 0)
+        assert tf.reduce_all(attention_weights[1, :, 1:] == 0)
+        np.testing.assert_allclose(tf.reduce_sum(attention_weights, axis=-1), 1.0, rtol=1e-6)
+
+    def test_causal_bias_is_cached(self):
+        attention = DotProductAttention(causal_mask=True)
+        x = tf.random.uniform((2, 4, 6))
+        _, attention_weights = attention(x, x, x)
+        cached_bias = attention._cached_causal_bias
+        assert cached_bias.shape == (4, 4)
+
+        # shorter sequences reuse a slice of the cached bias
+        y = tf.random.uniform((2, 3, 6))
+        _, attention_weights = attention(y, y, y)
+        assert attention._cached_causal_bias is cached_bias
+        upper = 1 - tf.linalg.band_part(tf.ones((3, 3)), -1, 0)
+        assert tf.reduce_all(attention_weights * upper == 0)
+
+        # longer key sequences grow it
+        z = tf.random.uniform((2, 6, 6))
+        _, attention_weights = attention(y, z, z)
+        assert attention._cached_causal_bias.shape == (6, 6)
+        assert attention_weights.shape == (2, 3, 6)
+
+    def test_causal_bias_beyond_max_len(self):
+        attention = DotProductAttention(causal_mask=True, max_len=4)
+        x = tf.random.uniform((2, 6, 8))
+        _, attention_weights = attention(x, x, x)
+        # the bias is built from the positions instead of growing the cache past max_len
+        assert attention._cached_causal_bias is None
+        upper = 1 - tf.linalg.band_part(tf.ones((6, 6)), -1, 0)
+        assert tf.reduce_all(attention_weights * upper == 0)
+
+    def test_causal_bias_with_query_offset(self):
+        attention = DotProductAttention(causal_mask=True)
+        x = tf.random.uniform((2, 6, 8))
+        _, expected = attention(x, x, x)
+        # the last two queries attend to the keys up to their own position
+        for query_offset in (4, tf.constant(4)):
+            _, attention_weights = attention(x[:, 4:], x, x, query_offset=query_offset)
+            np.testing.assert_allclose(attention_weights, expected[:, 4:], rtol=1e-6)
+
+    def test_scaling(self):
+        queries = tf.random.uniform((2, 3, 16))
+        keys = tf.random.uniform((2, 5, 16))
+        _, attention_weights = DotProductAttention()(queries, keys, keys)
+        expected = tf.nn.softmax(tf.matmul(queries, keys, transpose_b=True) / 4.0, axis=-1)
+        np.testing.assert_allclose(attention_weights, expected, rtol=1e-5, atol=1e-6)
+
+    def test_dropout_only_in_training(self):
+        x = tf.random.uniform((2, 3, 4))
+        attention = DotProductAttention(dropout_rate=0.5)
+        inference_output, _ = attention(x, x, x, training=False)
+        reference_output, _ = DotProductAttention()(x, x, x)
+        np.testing.assert_allclose(inference_output, reference_output, rtol=1e-6)
+
+        tf.random.set_seed(0)
+        training_output, _ = attention(x, x, x, training=True)
+        assert not np.allclose(training_output, inference_output)
+
+    def test_fused_attention(self):
+        x = tf.random.normal((2, 4, 6, 8))
+        attention_mask = tf.sequence_mask([4, 6], 6)
+        for scaled in (True, False):
+            expected, _ = DotProductAttention(scaled=scaled, causal_mask=True)(
+                x, x, x, attention_mask
+            )
+            output, attention_weights = DotProductAttention(
+                scaled=scaled, causal_mask=True, fused_attention=True
+            )(x, x, x, attention_mask)
+            assert attention_weights is None
+            np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-5)
+
+        x = tf.random.normal((2, 6, 8))
+        expected, _ = DotProductAttention()(x, x, x)
+        output, _ = DotProductAttention(fused_attention=True)(x, x, x)
+        np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-5)
+
+    def test_fused_attention_mixed_precision(self):
+        x = tf.random.normal((2, 4, 6, 8))
+        expected, _ = DotProductAttention(causal_mask=True)(x, x, x)
+        output, _ = DotProductAttention(
+            causal_mask=True, fused_attention=True, dtype="mixed_bfloat16"
+        )(x, x, x)
+        assert output.dtype == tf.bfloat16
+        np.testing.assert_allclose(tf.cast(output, tf.float32), expected, rtol=0.05, atol=0.05)
+
+    def test_fused_attention_requires_keras_3(self, monkeypatch):
+        monkeypatch.delattr(tf.keras.ops, "dot_product_attention")
+        with pytest.raises(ValueError):
+            DotProductAttention(fused_attention=True)
+
+    def test_quantized_attention_is_inference_only(self):
+        x = tf.random.normal((2, 4, 10, 16))
+        attention = DotProductAttention(dropout_rate=0.5, quantized_attention=True)
+        with pytest.raises(ValueError):
+            attention(x, x, x, training=True)
+        output, _ = attention(x, x, x, training=False)
+        expected, _ = DotProductAttention(dropout_rate=0.5)(x, x, x, training=False)
+        np.testing.assert_allclose(output, expected, rtol=0.05, atol=0.05)
+
+    def test_valid_lens_mask(self):
+        x = tf.random.normal((2, 4, 6))
+        valid_lens = tf.constant([2, 4])
+        for fused_attention in (False, True):
+            attention = DotProductAttention(fused_attention=fused_attention)
+            output, _ = attention(x, x, x, valid_lens)
+            expected, attention_weights = DotProductAttention()(
+                x, x, x, tf.sequence_mask(valid_lens, 4)
+            )
+            np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(attention_weights[0, :, 2:], 0.0, atol=1e-6)
@@ -4,6 +4,7 @@ import tensorflow as tf
 from tensorflow import keras
 
 from transformerx.layers import MultiHeadAttention
+from transformerx.layers.multihead_attention import _ProjectionDense
 
 
 # def test_multihead_attention():
@@ -110,6 +111,18 @@ class TestMultiHeadAttention:
         queries_split = attention.split_heads(queries)
         assert queries_split.shape == (3, 4, 10, 4)
 
+    def test_split_heads_dynamic_shapes(self, attention):
+        @tf.function(input_signature=[tf.TensorSpec((None, None, 16), tf.float32)])
+        def round_trip(X):
+            split = attention.split_heads(X)
+            assert split.shape.as_list() == [None, 4, None, 4]
+            merged = attention.inverse_transpose_qkv(split)
+            assert merged.shape.as_list() == [None, None, 16]
+            return merged
+
+        x = tf.random.normal((3, 10, 16))
+        np.testing.assert_array_equal(round_trip(x), x)
+
     def test_multihead_attention_init(self):
         # Test the initialization of the MultiHeadAttention class
         multihead = MultiHeadAttention(d_model=8)
@@ -127,6 +140,13 @@ class TestMultiHeadAttention:
         queries = attention.inverse_transpose_qkv(queries_split)
         assert queries.shape == (3, 10, 16)
 
+    def test_split_heads_round_trip(self, attention):
+        x = tf.random.normal((3, 10, 16))
+        split = attention.split_heads(x)
+        # head h holds the h-th slice of the depth axis
+        np.testing.assert_array_equal(split[:, 1], x[..., 4:8])
+        np.testing.assert_array_equal(attention.inverse_transpose_qkv(split), x)
+
     def test_multihead_attention_with_mask(self):
         attention = MultiHeadAttention(d_model=64, num_heads=8)
         # create a batch of inputs and a mask
@@ -182,3 +202,258 @@ class TestMultiHeadAttention:
         output, _ = attention(queries, keys, values, attention_mask=attention_mask)
 
         assert output.shape == (4, 10, 32)
+
+    def test_fused_qkv(self):
+        x = tf.random.normal((2, 5, 16))
+        fused = MultiHeadAttention(d_model=16, num_heads=4, use_bias=True, fused_qkv=True)
+        self_output, _ = fused(x, x, x)
+        assert self_output.shape == (2, 5, 16)
+        assert not hasattr(fused, "W_q")
+
+        # copies of x go through the per-input slices of the packed kernel instead of the single GEMM
+        cross_output, _ = fused(tf.identity(x), tf.identity(x), tf.identity(x))
+        np.testing.assert_allclose(cross_output, self_output, rtol=1e-5, atol=1e-5)
+
+        unfused = MultiHeadAttention(d_model=16, num_heads=4, use_bias=True)
+        unfused(x, x, x)
+        kernels = tf.split(fused.W_qkv.kernel, 3, axis=-1)
+        biases = tf.split(fused.W_qkv.bias, 3)
+        for layer, kernel, bias in zip((unfused.W_q, unfused.W_k, unfused.W_v), kernels, biases):
+            layer.set_weights([kernel.numpy(), bias.numpy()])
+        unfused.W_o.set_weights(fused.W_o.get_weights())
+        unfused_output, _ = unfused(x, x, x)
+        np.testing.assert_allclose(unfused_output, self_output, rtol=1e-5, atol=1e-5)
+
+    def test_attention_mask_is_broadcast_across_heads(self, attention):
+        x = tf.random.normal((2, 5, 32))
+        attention_mask = tf.constant([[1, 1, 1, 0, 0], [1, 1, 1, 1, 1]])
+        _, attention_weights = attention(x, x, x, attention_mask=attention_mask)
+        assert attention_weights.shape == (2, 4, 5, 5)
+        assert tf.reduce_all(attention_weights[0, ..., 3:] == 0)
+        assert tf.reduce_all(attention_weights[1] > 0)
+
+    def test_invalid_num_heads(self):
+        with pytest.raises(ValueError):
+            MultiHeadAttention(d_model=30, num_heads=4)
+
+    def test_attention_mechanism(self):
+        assert MultiHeadAttention(attention="scaled_dotproduct").attention.scaled
+        assert not MultiHeadAttention(attention="dotproduct").attention.scaled
+        with pytest.raises(ValueError):
+            MultiHeadAttention(attention="additive")
+
+    def test_jit_compile(self):
+        x = tf.random.normal((2, 5, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4, causal_mask=True)
+        jit_attention = MultiHeadAttention(
+            d_model=16, num_heads=4, causal_mask=True, jit_compile=True
+        )
+        output, _ = attention(x, x, x)
+        jit_attention(x, x, x)
+        jit_attention.set_weights(attention.get_weights())
+        jit_output, _ = jit_attention(x, x, x)
+        assert jit_attention.head_dim == 4
+        np.testing.assert_allclose(jit_output, output, rtol=1e-5, atol=1e-5)
+
+    def test_output_projection_merges_heads(self):
+        x = tf.random.normal((2, 5, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4, use_bias=True)
+        output, _ = attention(x, x, x)
+
+        queries = attention.split_heads(attention.W_q(x))
+        keys = attention.split_heads(attention.W_k(x))
+        values = attention.split_heads(attention.W_v(x))
+        attention_output, _ = attention.attention(queries, keys, values)
+        expected = attention.W_o(attention.inverse_transpose_qkv(attention_output))
+        np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-5)
+
+    def test_jit_compile_fused_qkv(self):
+        x = tf.random.normal((2, 5, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4, fused_qkv=True)
+        jit_attention = MultiHeadAttention(
+            d_model=16, num_heads=4, fused_qkv=True, jit_compile=True
+        )
+        output, _ = attention(x, x, x)
+        jit_attention(x, x, x)
+        jit_attention.set_weights(attention.get_weights())
+        np.testing.assert_allclose(jit_attention(x, x, x)[0], output, rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(
+            jit_attention(x, tf.identity(x), tf.identity(x))[0], output, rtol=1e-5, atol=1e-5
+        )
+
+    def test_mixed_precision(self):
+        x = tf.random.normal((2, 5, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4, dtype="mixed_bfloat16")
+        output, attention_weights = attention(x, x, x)
+        assert output.dtype == tf.bfloat16
+        assert attention_weights.dtype == tf.float32
+        assert attention.W_q.compute_dtype == "bfloat16"
+        assert attention.W_q.kernel.dtype == tf.float32
+
+    def test_fused_qkv_self_attention_matches_cross_attention_path(self):
+        x = tf.random.normal((2, 5, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4, use_bias=True, fused_qkv=True)
+        attention(x, x, x)
+        attention.W_qkv.bias.assign(tf.random.normal((48,)))
+        for fused, separate in zip(
+            attention.fused_projections(x, x, x),
+            attention.fused_projections(x, tf.identity(x), tf.identity(x)),
+        ):
+            assert fused.shape == (2, 4, 5, 4)
+            np.testing.assert_allclose(fused, separate, rtol=1e-5, atol=1e-5)
+
+    def test_fused_attention(self):
+        x = tf.random.normal((2, 5, 16))
+        attention_mask = tf.sequence_mask([3, 5], 5)
+        attention = MultiHeadAttention(d_model=16, num_heads=4, causal_mask=True)
+        fused_attention = MultiHeadAttention(
+            d_model=16, num_heads=4, causal_mask=True, fused_attention=True
+        )
+        output, _ = attention(x, x, x, attention_mask)
+        fused_attention(x, x, x, attention_mask)
+        fused_attention.set_weights(attention.get_weights())
+        fused_output, attention_weights = fused_attention(x, x, x, attention_mask)
+        assert attention_weights is None
+        np.testing.assert_allclose(fused_output, output, rtol=1e-5, atol=1e-5)
+
+    @pytest.mark.parametrize("fused_qkv", [False, True])
+    def test_kv_cache(self, fused_qkv):
+        x = tf.random.normal((2, 6, 16))
+        attention = MultiHeadAttention(
+            d_model=16, num_heads=4, causal_mask=True, fused_qkv=fused_qkv
+        )
+        expected, _ = attention(x, x, x)
+
+        # decode step by step, projecting only the new position each time
+        output, _, past_kv = attention(x[:, :2], x[:, :2], x[:, :2], use_cache=True)
+        outputs = [output]
+        for i in range(2, 6):
+            step = x[:, i : i + 1]
+            output, _, past_kv = attention(step, step, step, past_kv=past_kv, use_cache=True)
+            outputs.append(output)
+        assert past_kv[0].shape == (2, 4, 6, 4)
+        np.testing.assert_allclose(tf.concat(outputs, axis=1), expected, rtol=1e-5, atol=1e-5)
+
+    @pytest.mark.parametrize("fused_qkv", [False, True])
+    def test_fixed_capacity_kv_cache_under_jit(self, fused_qkv):
+        x = tf.random.normal((2, 6, 16))
+        attention = MultiHeadAttention(
+            d_model=16, num_heads=4, causal_mask=True, fused_qkv=fused_qkv, jit_compile=True
+        )
+        expected, _ = attention(x, x, x)
+        tracing_count = attention._call.experimental_get_tracing_count()
+
+        past_kv = attention.init_cache(batch_size=2, max_len=8)
+        output, _, past_kv = attention(x[:, :2], x[:, :2], x[:, :2], past_kv=past_kv, use_cache=True)
+        outputs = [output]
+        for i in range(2, 6):
+            step = x[:, i : i + 1]
+            output, _, past_kv = attention(step, step, step, past_kv=past_kv, use_cache=True)
+            outputs.append(output)
+        assert past_kv[0].shape == (2, 4, 8, 4)
+        assert int(past_kv[2]) == 6
+        # one trace for the prompt and one shared by all the decoding steps
+        assert attention._call.experimental_get_tracing_count() - tracing_count == 2
+        np.testing.assert_allclose(tf.concat(outputs, axis=1), expected, rtol=1e-5, atol=1e-5)
+
+    def test_kv_cache_reuse_without_projection(self):
+        queries = tf.random.normal((2, 3, 16))
+        memory = tf.random.normal((2, 7, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4)
+        expected, _, past_kv = attention(queries, memory, memory, use_cache=True)
+        output, _ = attention(queries, None, None, past_kv=past_kv)
+        np.testing.assert_allclose(output, expected, rtol=1e-6)
+
+    @pytest.mark.parametrize("fused_qkv", [False, True])
+    def test_shared_key_value_projection(self, fused_qkv):
+        queries = tf.random.normal((2, 3, 16))
+        memory = tf.random.normal((2, 7, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4, use_bias=True, fused_qkv=fused_qkv)
+        attention(queries, memory, memory)
+        for weight in attention.trainable_weights:
+            weight.assign(tf.random.normal(weight.shape))
+        output, _ = attention(queries, memory, memory)
+        expected, _ = attention(queries, memory, tf.identity(memory))
+        np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-5)
+
+    @pytest.mark.parametrize("fused_qkv", [False, True])
+    def test_int8_quantization(self, fused_qkv):
+        x = tf.random.normal((2, 5, 16))
+        memory = tf.random.normal((2, 7, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4, use_bias=True, fused_qkv=fused_qkv)
+        output, _ = attention(x, x, x)
+        cross_output, _ = attention(x, memory, memory)
+
+        attention.quantize("int8")
+        assert all(
+            weight.dtype == "int8" for weight in attention.weights if weight.path.endswith("kernel")
+        )
+        if not fused_qkv:
+            # the projections match the int8 matmul of the quantized Dense layers
+            np.testing.assert_allclose(
+                attention._project(x, 0), attention.split_heads(attention.W_q(x)), rtol=1e-5, atol=1e-5
+            )
+        np.testing.assert_allclose(attention(x, x, x)[0], output, rtol=0.05, atol=0.05)
+        np.testing.assert_allclose(
+            attention(x, memory, memory)[0], cross_output, rtol=0.05, atol=0.05
+        )
+
+    @pytest.mark.parametrize("mode", ["int4", "float8"])
+    def test_unsupported_quantization_mode(self, mode):
+        x = tf.random.normal((2, 5, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4)
+        output, _ = attention(x, x, x)
+        with pytest.raises(ValueError):
+            attention.quantize(mode)
+        with pytest.raises(ValueError):
+            attention.W_q.quantize(mode)
+        assert attention.W_q.kernel.dtype == tf.float32
+        np.testing.assert_allclose(attention(x, x, x)[0], output)
+
+    def test_unsupported_quantization_mode_in_model(self):
+        inputs = tf.keras.Input((5, 16))
+        outputs = MultiHeadAttention(d_model=16, num_heads=4)(inputs, inputs, inputs)[0]
+        model = tf.keras.Model(inputs, outputs)
+        with pytest.raises(ValueError):
+            model.quantize("float8")
+
+    def test_quantized_dtype_policy(self):
+        with pytest.raises(ValueError):
+            MultiHeadAttention(d_model=16, num_heads=4, dtype="int8_from_float32")
+        with pytest.raises(ValueError):
+            _ProjectionDense(16, dtype="float8_from_float32").build((None, 16))
+        projection = _ProjectionDense(16, dtype="int8_from_float32")
+        projection.build((None, 16))
+        assert projection.kernel.dtype == tf.int8
+
+    @pytest.mark.parametrize("first_training", [True, False])
+    def test_jit_compile_training_mode(self, first_training):
+        x = tf.random.normal((2, 6, 16))
+        attention = MultiHeadAttention(
+            d_model=16, num_heads=4, dropout_rate=0.5, jit_compile=True
+        )
+        attention(x, x, x, training=first_training)
+        inference_output, attention_weights = attention(x, x, x, training=False)
+        np.testing.assert_allclose(attention(x, x, x, training=False)[0], inference_output)
+        np.testing.assert_allclose(attention(x, x, x)[0], inference_output)
+        assert not np.allclose(attention(x, x, x, training=True)[0], inference_output)
+        np.testing.assert_allclose(attention(x, x, x, training=False)[0], inference_output)
+        np.testing.assert_allclose(
+            attention.attention.get_attention_weights(), attention_weights
+        )
+
+    def test_valid_lens_mask(self):
+        x = tf.random.normal((2, 5, 16))
+        attention = MultiHeadAttention(d_model=16, num_heads=4)
+        output, attention_weights = attention(x, x, x, tf.constant([2, 5]))
+        np.testing.assert_allclose(tf.reduce_sum(attention_weights[0, :, :, 2:]), 0.0, atol=1e-6)
+        expected, _ = attention(x, x, x, tf.sequence_mask([2, 5], 5))
+        np.testing.assert_allclose(output, expected, rtol=1e-6)
+
+    def test_projections_reject_bypassed_dense_features(self):
+        attention = MultiHeadAttention(d_model=16, num_heads=4)
+        attention(tf.zeros((1, 3, 16)), tf.zeros((1, 3, 16)), tf.zeros((1, 3, 16)))
+        with pytest.raises(ValueError):
+            attention.W_q.enable_lora(2)
+        with pytest.raises(ValueError):
+            _ProjectionDense(16, activation="relu")
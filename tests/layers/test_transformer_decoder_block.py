@@ -40,6 +40,15 @@ class TestTransformerDecoderBlock:
         assert attn1_weights.shape == (batch_size, 8, seq_length, seq_length)
         assert attn2_weights.shape == (batch_size, 8, seq_length, seq_length)
 
+    def test_fused_qkv(self):
+        queries = tf.random.uniform((2, 5, 64))
+        keys = tf.random.uniform((2, 10, 64))
+        decoder_block = TransformerDecoderBlock(d_model=64, fused_qkv=True)
+        output, _, _ = decoder_block(queries, keys, keys)
+        assert output.shape == (2, 5, 64)
+        assert hasattr(decoder_block.attention1, "W_qkv")
+        assert not hasattr(decoder_block.attention2, "W_qkv")
+
     @pytest.fixture
     def transformer_block(self):
         return TransformerDecoderBlock()
@@ -38,6 +38,13 @@ class TestTransformerEncoderBlock:
         output_tensor, attn_weights = transformer_encoder_block(x)
         assert tf.math.reduce_max(tf.norm(output_tensor, axis=-1)) <= 1.0
 
+    def test_transformer_encoder_block_with_fused_qkv(self):
+        x = tf.random.uniform((4, 10, 64))
+        encoder_block = TransformerEncoderBlock(d_model=64, fused_qkv=True)
+        output_tensor, attn_weights = encoder_block(x)
+        assert output_tensor.shape == (4, 10, 64)
+        assert hasattr(encoder_block.attention, "W_qkv")
+
     def test_transformer_encoder_block_with_layer_norm(self, transformer_encoder_block):
         x = tf.random.uniform((32, 10, 512))
         transformer_encoder_block.use_norm = True
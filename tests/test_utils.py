@@ -0,0 +1,33 @@
+import numpy as np
+import tensorflow as tf
+
+from transformerx.utils import masked_softmax
+
+
+class TestMaskedSoftmax:
+    def test_no_mask(self):
+        x = tf.random.uniform((2, 3, 4))
+        output = masked_softmax(x, None)
+        np.testing.assert_allclose(output, tf.nn.softmax(x, axis=-1), rtol=1e-6)
+
+    def test_1d_valid_lens(self):
+        x = tf.random.uniform((2, 3, 4))
+        output = masked_softmax(x, tf.constant([2, 3]))
+        assert output.shape == x.shape
+        np.testing.assert_allclose(output[0, :, 2:], 0.0)
+        np.testing.assert_allclose(output[1, :, 3:], 0.0)
+        np.testing.assert_allclose(tf.reduce_sum(output, axis=-1), 1.0, rtol=1e-6)
+
+    def test_2d_valid_lens(self):
+        x = tf.random.uniform((2, 2, 4))
+        output = masked_softmax(x, tf.constant([[1, 3], [2, 4]]))
+        np.testing.assert_allclose(output[0, 0, 1:], 0.0)
+        np.testing.assert_allclose(output[0, 1, 3:], 0.0)
+        np.testing.assert_allclose(output[1, 0, 2:], 0.0)
+        np.testing.assert_allclose(tf.reduce_sum(output, axis=-1), 1.0, rtol=1e-6)
+
+    def test_4d_scores(self):
+        x = tf.random.uniform((2, 4, 3, 5))
+        output = masked_softmax(x, tf.constant([2, 5]))
+        assert output.shape == x.shape
+        np.testing.assert_allclose(output[0, ..., 2:], 0.0)
@@ -1,10 +1,25 @@
+import math
+
+import numpy as np
 import tensorflow as tf
 
 # from transformerx.layers.masks.global_attention_mask import GlobalAttentionMask
-from transformerx.utils import masked_softmax
 from transformerx.layers.masks import LookAheadMask, PaddingMask
 
 
+def _quantize_int8(x, axis=-1):
+    """Symmetrically quantize `x` to int8 with one float32 scale per slice along `axis`."""
+    x = tf.cast(x, dtype=tf.float32)
+    scale = tf.reduce_max(tf.abs(x), axis=axis, keepdims=True) / 127.0
+    scale = tf.maximum(scale, tf.keras.backend.epsilon())
+    return tf.cast(tf.round(x / scale), dtype=tf.int8), scale
+
+
+def _int8_matmul(a, b, adj_y=False):
+    """Multiply two int8 tensors with int32 accumulation."""
+    return tf.raw_ops.BatchMatMulV3(x=a, y=b, Tout=tf.int32, adj_y=adj_y)
+
+
 class DotProductAttention(tf.keras.layers.Layer):
     """Compute (scaled) dot-product attention [1]_
 
@@ -16,6 +31,25 @@ class DotProductAttention(tf.keras.layers.Layer):
         Fraction of the input units to drop. A float between 0 and 1.
     scaled : bool
         Indicate whether to scale the dot-product
+    max_len : int
+        The longest sequence length for which the causal mask is cached as a constant, by default 512. The cached
+        (max_len, max_len) bias is only sliced on every call. Longer sequences, and queries that are offset from the
+        first key (e.g. when decoding with a key/value cache), build the causal bias on the fly from the positions
+        instead, so the cache never grows beyond max_len.
+    quantized_attention : bool
+        Whether to run the two attention matmuls in int8 with int32 accumulation. Queries and keys are quantized per
+        row, the attention weights per row and the values per column, and the results are dequantized to float32.
+        This is meant for inference only since the quantization is not differentiable, so calling the layer with
+        training=True raises a ValueError.
+    jit_compile : bool
+        Whether to compile the attention computation with XLA so the scaling, masking, softmax, dropout, and matmuls
+        are fused into fewer kernels
+    fused_attention : bool
+        Whether to compute the attention with the backend's fused ``keras.ops.dot_product_attention`` kernel, which
+        uses Flash Attention where the backend and device support it. The attention weights are then not returned
+        (None), and the regular path is used instead whenever dropout is active, a padding mask is set, or
+        quantized_attention is on. Requires Keras 3, otherwise a ValueError is raised. Under a mixed precision policy
+        the fused kernel runs in float32.
 
     Returns
     -------
@@ -95,6 +129,10 @@ class DotProductAttention(tf.keras.layers.Layer):
         mask_type="dilated",
         mask_prob=0.0,
         dilation_rate=1,
+        max_len: int = 512,
+        quantized_attention: bool = False,
+        jit_compile: bool = False,
+        fused_attention: bool = False,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -109,6 +147,20 @@ class DotProductAttention(tf.keras.layers.Layer):
         self.mask_type = mask_type
         self.mask_prob = mask_prob
         self.dilation_rate = dilation_rate
+        # the masks are created once here rather than on every call so the traced graph keeps the same structure
+        self.look_ahead_mask = LookAheadMask() if self.causal_mask else None
+        self.max_len = max_len
+        self._cached_causal_bias = None
+        # todo: pass the padding mask object or a string denoting it to the __init__()
+        self.padding_mask_layer = PaddingMask() if self.padding_mask else None
+        self.quantized_attention = quantized_attention
+        self.fused_attention = fused_attention
+        if self.fused_attention and not hasattr(getattr(tf.keras, "ops", None), "dot_product_attention"):
+            raise ValueError("fused_attention requires Keras 3, which provides keras.ops.dot_product_attention")
+        self.jit_compile = jit_compile
+        if self.jit_compile:
+            # Let XLA fuse the scale, mask, softmax, dropout and the two matmuls instead of running them one by one
+            self._attend = tf.function(self._attend, jit_compile=True)
         # self.global_mask = GlobalAttentionMask(
         #     mask_type=self.mask_type,
         #     mask_prob=self.mask_prob,
@@ -116,12 +168,19 @@ class DotProductAttention(tf.keras.layers.Layer):
         # )
 
     def build(self, input_shape):
+        if self.causal_mask and input_shape[-2] is not None and input_shape[-2] <= self.max_len:
+            # prebuild the causal bias for the query length so the first call only needs to slice it
+            self._causal_bias(input_shape[-2], input_shape[-2])
         super().build(input_shape)
 
     # Shape of queries: (batch_size, num_heads, seq_len, head_size) or (batch_size, q_seq_len, d_model)
     # Shape of keys: (batch_size, num_heads, seq_len, head_size) or (batch_size, k_seq_len, d_model)
     # Shape of values: (batch_size, num_heads, seq_len, head_size) or (batch_size, v_seq_len, d_model)
-    # Shape of attention_mask: (batch_size,) or (batch_size, no. of queries)
+    # Shape of attention_mask: (batch_size,) holding the valid lengths of the keys, or a keep mask of shape
+    # (batch_size, k_seq_len), (batch_size, q_seq_len, k_seq_len) or any shape broadcastable to the scores once
+    # singleton axes are inserted after the batch axis. Nonzero (True) entries of a keep mask are attended to.
+    # query_offset is the position of the first query among the keys, e.g. the number of cached keys when decoding
+    # step by step, so the causal mask lets the queries attend to all the keys up to their own position.
     def call(
         self,
         queries: tf.Tensor,
@@ -129,41 +188,194 @@ class DotProductAttention(tf.keras.layers.Layer):
         values: tf.Tensor,
         attention_mask: tf.Tensor = None,
         training=None,
+        query_offset=0,
         **kwargs,
     ) -> tf.Tensor:
-        scores = tf.matmul(queries, keys, transpose_b=True)
+        if self.quantized_attention and training:
+            raise ValueError(
+                "quantized_attention is meant for inference only (the quantization is not differentiable), "
+                "it cannot be used with training=True"
+            )
+        attention_output, self.attention_weights = self._attend(
+            queries, keys, values, attention_mask, training=training, query_offset=query_offset
+        )
+        return attention_output, self.attention_weights
+
+    def _attend(self, queries, keys, values, attention_mask=None, training=None, query_offset=0):
+        if attention_mask is not None and len(attention_mask.shape) == 1:
+            # valid lengths: only the first valid_lens[i] keys of the i-th sequence are attended to
+            attention_mask = tf.sequence_mask(attention_mask, tf.shape(keys)[-2])
+
+        if (
+            self.fused_attention
+            and not (training and self.dropout_rate > 0)
+            # the fused kernel only supports a causal mask aligned with the first key
+            and (not self.causal_mask or (isinstance(query_offset, int) and query_offset == 0))
+            and self.padding_mask_layer is None
+            and not self.quantized_attention
+        ):
+            return self._fused_attend(queries, keys, values, attention_mask), None
+
+        if self.quantized_attention:
+            queries_int8, queries_scale = _quantize_int8(queries)
+            keys_int8, keys_scale = _quantize_int8(keys)
+            scores = tf.cast(_int8_matmul(queries_int8, keys_int8, adj_y=True), dtype=tf.float32)
+            scores = scores * queries_scale * tf.linalg.matrix_transpose(keys_scale)
+        else:
+            scores = tf.matmul(queries, keys, transpose_b=True)
         if self.scaled:
             d_model = queries.shape[-1]
-
-            scores = scores / tf.math.sqrt(tf.cast(d_model, dtype=queries.dtype))
-
-        # apply causal mask
-        if self.causal_mask:
-            # New version of masking
-            look_ahead_mask = LookAheadMask()
-            scores = look_ahead_mask(scores)
-            # todo: get different masks as a single or list of Callable or str objects and then invoke them in a loop
-            # todo: for performance reasons, first generate the boolean masks and then in the end add up them and then
-            #  multiply them once instead of generating masks and then multiply with 10-9 and add again etc.
-
-        # todo: pass the padding mask object or a string denoting it to the __init__()
-        if self.padding_mask:
-            padding_mask = PaddingMask()
-            scores = padding_mask(scores)
+            if d_model is not None:
+                # 1 / sqrt(d) is a python constant for a static depth, so scaling is a single multiply
+                scores = scores * (1.0 / math.sqrt(d_model))
+            else:
+                d_model = tf.shape(queries)[-1]
+                scores = scores * tf.math.rsqrt(tf.cast(d_model, dtype=scores.dtype))
+
+        # Under a mixed precision policy the matmuls run in (b)float16 on tensor cores while the masking and softmax
+        # stay in float32 for numerical stability (a -1e9 mask value does not even fit in float16).
+        if scores.dtype in (tf.float16, tf.bfloat16):
+            scores = tf.cast(scores, dtype=tf.float32)
+
+        # All the masks are summed up into a single additive bias which is added to the scores once right before the
+        # softmax, so the scores are read and written only once no matter how many masks are active.
+        bias = self._attention_bias(scores, attention_mask, query_offset)
+        if bias is not None:
+            scores = scores + bias
 
         # to be uncommented later
         # apply global mask
         # gmask = self.global_mask.get_mask(keys.shape)
         # masked_attention_scores = tf.math.multiply(scores, gmask)
-        self.attention_weights = tf.nn.softmax(scores, axis=-1)
+        attention_weights = tf.nn.softmax(scores, axis=-1)
         # uncomment until here
 
-        # todo: remove this masked_softmax and use a simple softmax instead after integrating the new masking system
-        # self.attention_weights = masked_softmax(scores, attention_mask)
-        # self.attention_weights = tf.nn.softmax(scores, axis=-1, mask=attention_mask)
-        # scores = tf.matmul(self.dropout(self.attention_weights, **kwargs), values)
-        attention_output = tf.matmul(self.dropout(self.attention_weights), values)
-        return attention_output, self.attention_weights
+        # dropout is a no-op at inference, so it is skipped altogether rather than run with training=False
+        if training and self.dropout_rate > 0:
+            dropped_weights = self.dropout(attention_weights, training=training)
+        else:
+            dropped_weights = attention_weights
+
+        if self.quantized_attention:
+            # the weights are quantized per row with their own max, which keeps more precision for the rows whose
+            # weights are spread out (and thus small) than a fixed 1 / 127 scale
+            weights_int8, weights_scale = _quantize_int8(dropped_weights)
+            values_int8, values_scale = _quantize_int8(values, axis=-2)
+            attention_output = tf.cast(_int8_matmul(weights_int8, values_int8), dtype=tf.float32)
+            attention_output = tf.cast(attention_output * weights_scale * values_scale, dtype=values.dtype)
+        else:
+            attention_output = tf.matmul(
+                tf.cast(dropped_weights, dtype=values.dtype), values
+            )
+        return attention_output, attention_weights
+
+    def _fused_attend(self, queries, keys, values, attention_mask=None):
+        """Compute the attention with the fused kernel without materializing the attention weights."""
+        rank = len(queries.shape)
+        output_dtype = values.dtype
+        # The TensorFlow backend runs the softmax in the input dtype, so 16-bit inputs are upcast to keep it in float32
+        # as in the regular path
+        if output_dtype in (tf.float16, tf.bfloat16):
+            queries, keys, values = (tf.cast(X, dtype=tf.float32) for X in (queries, keys, values))
+        # the fused op expects (batch_size, seq_len, num_heads, head_size), a 3d input is treated as a single head
+        if rank == 3:
+            queries, keys, values = (X[:, :, tf.newaxis, :] for X in (queries, keys, values))
+        else:
+            queries, keys, values = (tf.transpose(X, perm=(0, 2, 1, 3)) for X in (queries, keys, values))
+
+        if attention_mask is not None:
+            attention_mask = tf.cast(attention_mask, dtype=tf.bool)
+            for _ in range(4 - len(attention_mask.shape)):
+                attention_mask = tf.expand_dims(attention_mask, axis=1)
+
+        attention_output = tf.keras.ops.dot_product_attention(
+            queries,
+            keys,
+            values,
+            mask=attention_mask,
+            scale=None if self.scaled else 1.0,
+            is_causal=self.causal_mask,
+        )
+        attention_output = tf.cast(attention_output, dtype=output_dtype)
+        if rank == 3:
+            return attention_output[:, :, 0, :]
+        return tf.transpose(attention_output, perm=(0, 2, 1, 3))
+
+    def _attention_bias(self, scores, attention_mask=None, query_offset=0):
+        """Sum up the active masks into a single additive bias, or return None if no mask is active."""
+        q_len = tf.shape(scores)[-2]
+        k_len = tf.shape(scores)[-1]
+        biases = []
+
+        # apply causal mask
+        if self.look_ahead_mask is not None:
+            if (
+                isinstance(query_offset, int)
+                and query_offset == 0
+                and scores.shape[-2] is not None
+                and scores.shape[-1] is not None
+                and max(scores.shape[-2], scores.shape[-1]) <= self.max_len
+            ):
+                bias = self._causal_bias(scores.shape[-2], scores.shape[-1])
+            else:
+                bias = self._positional_causal_bias(q_len, k_len, query_offset)
+            biases.append(tf.cast(bias, dtype=scores.dtype))
+            # todo: get different masks as a single or list of Callable or str objects and then invoke them in a loop
+
+        if self.padding_mask_layer is not None:
+            mask = self.padding_mask_layer.build_mask(q_len, k_len, scores=scores)
+            biases.append(self.padding_mask_layer.mask_value * tf.cast(mask, dtype=scores.dtype))
+
+        if attention_mask is not None:
+            # the mask is only expanded (e.g. (batch_size, k_len) -> (batch_size, 1, 1, k_len)) and then broadcast
+            # against the scores, so it is never copied across the heads or queries
+            attention_mask = tf.cast(attention_mask, dtype=tf.bool)
+            for _ in range(len(scores.shape) - len(attention_mask.shape)):
+                attention_mask = tf.expand_dims(attention_mask, axis=1)
+            biases.append(
+                tf.where(
+                    attention_mask,
+                    tf.zeros([], dtype=scores.dtype),
+                    tf.constant(-1e9, dtype=scores.dtype),
+                )
+            )
+
+        if not biases:
+            return None
+        # the biases may have different (broadcastable) shapes, so they are not summed with tf.add_n
+        bias = biases[0]
+        for other in biases[1:]:
+            bias = bias + other
+        return bias
+
+    def _causal_bias(self, q_len, k_len):
+        """Return the (q_len, k_len) additive causal bias sliced from a cached constant.
+
+        The constant is an upper triangular matrix of mask values which is only rebuilt when a longer sequence (up to
+        max_len) is seen. It is created in the eager context so that it can be reused across calls and traced graphs.
+        """
+        size = max(q_len, k_len)
+        if self._cached_causal_bias is None or self._cached_causal_bias.shape[0] < size:
+            with tf.init_scope():
+                self._cached_causal_bias = tf.constant(
+                    np.triu(np.full((size, size), self.look_ahead_mask.mask_value), k=1),
+                    dtype=tf.float32,
+                )
+        return self._cached_causal_bias[:q_len, :k_len]
+
+    def _positional_causal_bias(self, q_len, k_len, query_offset=0):
+        """Build the (q_len, k_len) additive causal bias by comparing the key and query positions.
+
+        The i-th query sits at position query_offset + i, so it is masked from all the keys after that position. The
+        lengths and the offset may be tensors, so the bias works with dynamic shapes and a traced decode position.
+        """
+        query_positions = tf.range(q_len)[:, tf.newaxis] + tf.cast(query_offset, dtype=tf.int32)
+        key_positions = tf.range(k_len)[tf.newaxis, :]
+        return tf.where(
+            key_positions > query_positions,
+            tf.constant(self.look_ahead_mask.mask_value, dtype=tf.float32),
+            tf.zeros([], dtype=tf.float32),
+        )
 
     def get_attention_weights(self):
         return self.attention_weights
@@ -61,24 +61,16 @@ class PaddingMask(BaseMask):
 
             # mask = tf.cast(padding_mask, dtype=self.scores_dtype)
 
-        # fixme: later these functionality will be added again.
-        #  problem: it should construct a padding mask based on the valid_lens(valid lengths) tensor where each
-        #  sequence in the batch should be padded wrt the valid_lens tensor such that the final mask has the same
-        #  shape as the scores matrix so they can be added up together in the `call()` method in the BaseMask class.
-
-        # elif valid_lens is not None:
-        #     max_len = tf.maximum(q_len, k_len)
-        #     # max_len = tf.reduce_max(valid_lens)
-        #     print("here", self.padding_value)
-        #     mask = 1 - tf.sequence_mask(valid_lens, max_len, dtype=self.scores_dtype)
-        #     if input_shape:
-        #         if len(input_shape) == 3:
-        #             mask = tf.reshape(padding_mask, (input_shape[0], 1, input_shape[-1]))
-        #         elif len(input_shape) == 4:
-        #             mask = tf.reshape(padding_mask, (input_shape[0], 1, 1, input_shape[-1]))
-        #     else:
-        #         raise Exception("Input shape must be provided to reconstruct the mask with the same shape")
-        #     print("mask: ", mask)
+        elif valid_lens is not None:
+            # 1 for the key positions beyond each sequence's valid length. The mask is only expanded (never tiled or
+            # reshaped to the scores' shape) so it broadcasts against the scores when it is added to them.
+            mask = 1 - tf.sequence_mask(
+                valid_lens, k_len, dtype=self.scores_dtype or tf.float32
+            )
+            if scores is not None:
+                # (batch_size, [no. of queries,] k_len) -> (batch_size, 1, ..., [no. of queries,] k_len)
+                for _ in range(len(scores.shape) - len(mask.shape)):
+                    mask = tf.expand_dims(mask, axis=1)
 
         # receives the scores matrix and derive the padding mask before passing to the softmax
         elif scores is not None:
@@ -90,7 +82,6 @@ class PaddingMask(BaseMask):
                 "Either 'valid_lens', 'padding_mask' or \"'scores' along with the padding_value\" must be "
                 "provided."
             )
-        print("mask : ", mask)
         return mask
 
 
@@ -1,7 +1,73 @@
 import tensorflow as tf
-from einops import rearrange
 
-from transformerx.layers.dot_product_attention import DotProductAttention
+from transformerx.layers.dot_product_attention import (
+    DotProductAttention,
+    _int8_matmul,
+    _quantize_int8,
+)
+
+# Whether the dot-product is scaled for each of the supported attention mechanisms
+_ATTENTION_SCALING = {"scaled_dotproduct": True, "dotproduct": False, None: True}
+
+# The quantization modes supported by MultiHeadAttention.quantize
+_QUANTIZATION_MODES = ("int8",)
+
+
+def _check_quantization_mode(mode):
+    """Raise a ValueError unless ``mode`` is a quantization mode the einsum projections can run (float8 is not)."""
+    if mode not in _QUANTIZATION_MODES:
+        raise ValueError(
+            f"Unsupported quantization mode: {mode}. Expected one of {list(_QUANTIZATION_MODES)}"
+        )
+
+
+class _ProjectionDense(tf.keras.layers.Dense):
+    """A Dense layer which only holds the variables of a MultiHeadAttention projection.
+
+    MultiHeadAttention reads the kernel and bias directly in its einsum projections instead of calling the layer, so
+    the Dense features that live in Dense.call (an activation and LoRA) would be silently skipped. They are rejected
+    here instead. Kernel and bias constraints are applied by the optimizer and keep working.
+    """
+
+    def __init__(self, units, **kwargs):
+        if kwargs.get("activation") is not None:
+            raise ValueError("The MultiHeadAttention projections do not support an activation")
+        super().__init__(units, **kwargs)
+
+    def enable_lora(self, *args, **kwargs):
+        raise ValueError("The MultiHeadAttention projections do not support LoRA")
+
+    def build(self, input_shape):
+        # A quantized dtype policy (e.g. "int8_from_float32") quantizes the layer when it is built
+        mode = getattr(self, "quantization_mode", None)
+        if mode is not None:
+            _check_quantization_mode(mode)
+        super().build(input_shape)
+
+    def quantize(self, mode=None, **kwargs):
+        _check_quantization_mode(mode)
+        # Dense.quantize refuses subclasses unless the type check is skipped
+        super().quantize(mode, type_check=False, **kwargs)
+
+
+def _dense_kernel(layer):
+    """Return the kernel of a Dense layer and its int8 scale (None unless the layer was quantized to int8).
+
+    The projections read the Dense kernels directly rather than calling the layers, so the int8 kernels (with one
+    scale per output unit, float_kernel = kernel / kernel_scale) left by ``quantize("int8")`` are handled here.
+    ``quantization_mode`` only exists since Keras 3, hence the getattr.
+    """
+    mode = getattr(layer, "quantization_mode", None)
+    if mode == "int8":
+        return layer.kernel, layer.kernel_scale
+    return layer.kernel, None
+
+
+def _quantized_matmul(X, kernel, kernel_scale):
+    """Multiply X by an int8 kernel with int8 inputs (quantized per row) and int32 accumulation."""
+    X_int8, X_scale = _quantize_int8(X)
+    output = tf.cast(_int8_matmul(X_int8, kernel), dtype=tf.float32)
+    return tf.cast(output * X_scale / kernel_scale, dtype=X.dtype)
 
 
 class MultiHeadAttention(tf.keras.layers.Layer):
@@ -84,6 +150,26 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         The dropout rate to use for regularization. Float between 0 and 1.
     use_bias : bool, optional
         Whether to use bias terms in the linear transformations i.e. W_q, W_k, W_v, and W_o, by default False.
+    attention : str, optional
+        The attention mechanism, either "scaled_dotproduct" (default) or "dotproduct".
+    causal_mask : bool, optional
+        Whether to prevent the queries from attending to the subsequent positions, by default False.
+    fused_qkv : bool, optional
+        Whether to pack W_q, W_k, and W_v into a single W_qkv projection, by default False. For self-attention (the
+        same tensor passed as queries, keys, and values) the three projections are then computed with a single GEMM.
+        Queries, keys, and values must have the same depth.
+    jit_compile : bool, optional
+        Whether to compile the layer's computation with XLA, by default False. The Q/K/V projections, head split,
+        attention, and output projection are then fused into a few kernels, and since the per-head shapes are static
+        XLA generates kernels specialized for the head size.
+    fused_attention : bool, optional
+        Whether to compute the attention with the fused ``keras.ops.dot_product_attention`` kernel (Flash Attention
+        where the backend supports it), by default False. The (batch_size, num_heads, q_len, k_len) attention weights
+        are then not materialized and None is returned in their place, except while dropout is active in training.
+    dtype : str or tf.keras.DTypePolicy, optional
+        The dtype policy of the layer, shared with W_q, W_k, W_v, W_o and the attention layer. With a mixed policy
+        (e.g. "mixed_bfloat16" or "mixed_float16") the four projections and the attention matmuls run in 16-bit, while
+        the weights and the softmax are kept in float32.
 
     Returns
     -------
@@ -96,9 +182,15 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     -------
     split_heads(X)
         Transpose tensors for parallel computation of attention heads.
+    project_heads(X, kernel, bias=None)
+        Project a tensor and split it into heads in a single einsum.
+    fused_projections(queries, keys, values)
+        Project the queries, keys, and values with the packed W_qkv projection (only when fused_qkv is set).
     inverse_transpose_qkv(X)
         Reverse the operation of split_heads.
-    call(queries, keys, values, valid_lens, window_mask=None, **kwargs)
+    quantize(mode)
+        Quantize the weights of the projections, e.g. to int8 for inference.
+    call(queries, keys, values, attention_mask=None, **kwargs)
         Compute the multi-head attention for the given queries, keys, and values.
 
     Examples
@@ -140,15 +232,15 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     >>> queries = tf.random.normal((3, 20, 16))
     >>> keys = tf.random.normal((3, 20, 16))
     >>> values = tf.random.normal((3, 20, 16))
-    >>> valid_lens = tf.constant([3, 20])
-    >>> output, _ = attention(queries, keys, values)
+    >>> valid_lens = tf.constant([3, 20, 7])
+    >>> output, _ = attention(queries, keys, values, valid_lens)
     >>> print(output.shape)
     (3, 20, 16)
 
-    >>> window_mask = tf.ones((3, 10))
+    >>> window_mask = tf.ones((3, 20))
     >>> output, _ = attention(queries, keys, values, attention_mask=window_mask)
     >>> output.shape
-    (3, 10, 16)
+    (3, 20, 16)
 
 
     References
@@ -168,34 +260,68 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         use_bias: bool = False,
         attention: str = "scaled_dotproduct",
         causal_mask: bool = False,
+        fused_qkv: bool = False,
+        jit_compile: bool = False,
+        fused_attention: bool = False,
         **kwargs,
     ):
         super(MultiHeadAttention, self).__init__(**kwargs)
+        if d_model % num_heads != 0:
+            raise ValueError(
+                f"d_model ({d_model}) must be divisible by num_heads ({num_heads})"
+            )
+        if getattr(self, "quantization_mode", None) is not None:
+            raise ValueError(
+                "MultiHeadAttention does not take a quantized dtype policy, use quantize() once it is built instead"
+            )
         self.d_model = d_model
         self.num_heads = num_heads
+        self.head_dim = d_model // num_heads
         self.dropout_rate = dropout_rate
         self.use_bias = use_bias
         self.causal_mask = causal_mask
-        if attention == "scaled_dotproduct" or attention == None:
-            self.attention = DotProductAttention(
-                self.dropout_rate, scaled=True, causal_mask=self.causal_mask
+        self.fused_qkv = fused_qkv
+        self.jit_compile = jit_compile
+        self.fused_attention = fused_attention
+        if self.jit_compile:
+            self._call = tf.function(self._call, jit_compile=True)
+        if attention not in _ATTENTION_SCALING:
+            raise ValueError(
+                f"Unknown attention: {attention}. Expected one of {list(_ATTENTION_SCALING)}"
+            )
+        # The sublayers share this layer's dtype policy, so e.g. dtype="mixed_bfloat16" runs the projections and the
+        # attention matmuls in 16-bit while the variables (and the softmax) stay in float32
+        self.attention = DotProductAttention(
+            self.dropout_rate,
+            scaled=_ATTENTION_SCALING[attention],
+            causal_mask=self.causal_mask,
+            fused_attention=self.fused_attention,
+            dtype=self.dtype_policy,
+        )
+        if self.fused_qkv:
+            self.W_qkv = _ProjectionDense(
+                3 * self.d_model, use_bias=self.use_bias, dtype=self.dtype_policy, name="W_qkv"
+            )
+        else:
+            self.W_q = _ProjectionDense(
+                self.d_model, use_bias=self.use_bias, dtype=self.dtype_policy, name="W_q"
+            )
+            self.W_k = _ProjectionDense(
+                self.d_model, use_bias=self.use_bias, dtype=self.dtype_policy, name="W_k"
             )
-        elif attention == "dotproduct":
-            self.attention = DotProductAttention(
-                self.dropout_rate, scaled=False, causal_mask=self.causal_mask
+            self.W_v = _ProjectionDense(
+                self.d_model, use_bias=self.use_bias, dtype=self.dtype_policy, name="W_v"
             )
-        self.W_q = tf.keras.layers.Dense(self.d_model, use_bias=self.use_bias)
-        self.W_k = tf.keras.layers.Dense(self.d_model, use_bias=self.use_bias)
-        self.W_v = tf.keras.layers.Dense(self.d_model, use_bias=self.use_bias)
-        self.W_o = tf.keras.layers.Dense(self.d_model, use_bias=self.use_bias)
+        self.W_o = _ProjectionDense(
+            self.d_model, use_bias=self.use_bias, dtype=self.dtype_policy, name="W_o"
+        )
 
     def split_heads(self, X: tf.Tensor) -> tf.Tensor:
         """Transpose tensors for parallel computation of attention heads.
 
-        First transposition produces a tensor of shape x: (batch_size, num_heads, no. of queries or key-value pairs,
-        depth / num_heads).
-        Next it is rearranged to a new order (batch_size * num_heads, no. of queries or key-value pairs,
-        depth / num_heads) which is then passed to the last rearrangement and returned.
+        The tensor is split into heads and transposed to shape (batch_size, num_heads, no. of queries or key-value
+        pairs, depth / num_heads). The heads are kept as a separate axis rather than being merged into the batch axis,
+        so the attention matmuls run directly on the 4D tensors as a single strided batched GEMM.
 
         Parameters
         ----------
@@ -205,17 +331,118 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         Returns
         -------
         x : tf.Tensor
-            Transposed tensor of shape ((batch_size * num_heads, no. of queries or key-value pairs, depth / num_heads)
+            Transposed tensor of shape (batch_size, num_heads, no. of queries or key-value pairs, depth / num_heads)
         """
 
-        # x = tf.reshape(x, shape=(x.shape[0], x.shape[1], self.num_heads, -1))
-        X = rearrange(X, "b l (h dk) -> b l h dk", h=self.num_heads)
-        # x = tf.transpose(x, perm=(0, 2, 1, 3))
-        X = rearrange(X, "b l h dk -> b h l dk")
-        # return tf.reshape(x, shape=(-1, x.shape[2], x.shape[3]))
-        # X = rearrange(X, "b h l dk -> (b h) l dk")
+        # (batch_size, seq_len, depth) -> (batch_size, seq_len, num_heads, depth / num_heads)
+        # the static head dim is kept whenever it is known so the downstream shapes stay fully defined
+        head_dim = X.shape[-1] // self.num_heads if X.shape[-1] is not None else -1
+        X = tf.reshape(X, shape=(tf.shape(X)[0], tf.shape(X)[1], self.num_heads, head_dim))
+        # -> (batch_size, num_heads, seq_len, depth / num_heads)
+        return tf.transpose(X, perm=(0, 2, 1, 3))
+
+    def project_heads(
+        self, X: tf.Tensor, kernel: tf.Tensor, bias: tf.Tensor = None, kernel_scale: tf.Tensor = None
+    ) -> tf.Tensor:
+        """Project the tensor and split the result into heads with a single einsum.
+
+        The kernel is viewed as (depth, num_heads, depth / num_heads) so the projection writes its output directly
+        in the (batch_size, num_heads, seq_len, depth / num_heads) layout. This is equivalent to
+        split_heads(X @ kernel + bias), but the intermediate (batch_size, seq_len, d_model) tensor is never created.
+
+        Parameters
+        ----------
+        X : tf.Tensor
+            Shape (batch_size, no. of queries or key-value pairs, depth).
+        kernel : tf.Tensor
+            The projection kernel of shape (depth, d_model), e.g. W_q.kernel.
+        bias : tf.Tensor, optional
+            The projection bias of shape (d_model,), by default None.
+        kernel_scale : tf.Tensor, optional
+            The per-unit scale of shape (d_model,) of an int8 kernel, by default None. If given, the projection runs
+            as an int8 matmul followed by split_heads.
+
+        Returns
+        -------
+        tf.Tensor
+            Shape (batch_size, num_heads, no. of queries or key-value pairs, depth / num_heads)
+        """
+        X = tf.cast(X, dtype=self.compute_dtype)
+        if kernel_scale is not None:
+            X = _quantized_matmul(X, kernel, kernel_scale)
+            if bias is not None:
+                X = X + tf.cast(bias, dtype=X.dtype)
+            return self.split_heads(X)
+        kernel = tf.reshape(tf.cast(kernel, dtype=X.dtype), (-1, self.num_heads, self.head_dim))
+        X = tf.einsum("bld,dhk->bhlk", X, kernel)
+        if bias is not None:
+            X = X + tf.reshape(tf.cast(bias, dtype=X.dtype), (self.num_heads, 1, self.head_dim))
         return X
 
+    def fused_projections(self, queries, keys, values):
+        """Project the queries, keys, and values with the packed W_qkv projection.
+
+        For self-attention a single GEMM of width 3 * d_model is run, with the kernel viewed as
+        (depth, 3, num_heads, depth / num_heads) so the output is already split into heads. If only the keys and
+        values are the same tensor, they are projected together by the (contiguous) key and value slice of the packed
+        kernel. Otherwise, each input is projected by its own slice of the packed kernel.
+
+        Parameters
+        ----------
+        queries : tf.Tensor
+            Shape (batch_size, no. of queries, depth).
+        keys : tf.Tensor
+            Shape (batch_size, no. of key-value pairs, depth).
+        values : tf.Tensor
+            Shape (batch_size, no. of key-value pairs, depth).
+
+        Returns
+        -------
+        Tuple[tf.Tensor, tf.Tensor, tf.Tensor]
+            The projected queries, keys, and values, each of shape (batch_size, num_heads, no. of queries or key-value
+            pairs, depth / num_heads).
+        """
+        if not self.W_qkv.built:
+            self.W_qkv.build(queries.shape)
+
+        if queries is keys and keys is values:
+            kernel, kernel_scale = _dense_kernel(self.W_qkv)
+            return self._project_stacked(queries, kernel, self.W_qkv.bias, 3, kernel_scale)
+        if keys is values:
+            return [self._project(queries, 0), *self._project_kv(keys)]
+        return [self._project(X, index) for index, X in enumerate((queries, keys, values))]
+
+    def _project_stacked(self, X, kernel, bias, num, kernel_scale=None):
+        """Run num packed projections of X with a single einsum and return them split into heads."""
+        X = tf.cast(X, dtype=self.compute_dtype)
+        if kernel_scale is not None:
+            X = _quantized_matmul(X, kernel, kernel_scale)
+            if bias is not None:
+                X = X + tf.cast(bias, dtype=X.dtype)
+            return [self.split_heads(X) for X in tf.split(X, num, axis=-1)]
+        kernel = tf.reshape(tf.cast(kernel, dtype=X.dtype), (-1, num, self.num_heads, self.head_dim))
+        # (num, batch_size, num_heads, seq_len, depth / num_heads)
+        X = tf.einsum("bld,dshk->sbhlk", X, kernel)
+        if bias is not None:
+            X = X + tf.reshape(tf.cast(bias, dtype=X.dtype), (num, 1, self.num_heads, 1, self.head_dim))
+        return tf.unstack(X, num=num)
+
+    def _project_kv(self, X):
+        """Project X with both the key and the value projections.
+
+        With fused_qkv the key and value kernels are contiguous in the packed kernel and run as a single GEMM. The
+        separate W_k and W_v are not concatenated for this, since the per-call concat costs more than it saves.
+        """
+        if not self.fused_qkv:
+            return [self._project(X, 1), self._project(X, 2)]
+        if not self.W_qkv.built:
+            self.W_qkv.build(X.shape)
+        kernel, kernel_scale = _dense_kernel(self.W_qkv)
+        kernel = kernel[:, self.d_model :]
+        kernel_scale = kernel_scale[self.d_model :] if kernel_scale is not None else None
+        bias = self.W_qkv.bias[self.d_model :] if self.use_bias else None
+        return self._project_stacked(X, kernel, bias, 2, kernel_scale)
+
     def inverse_transpose_qkv(self, X: tf.Tensor) -> tf.Tensor:
         """Reverses the operation of split_heads for the input array X.
 
@@ -232,11 +459,60 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         """
 
         # transpose back to original shape: (batch_size, seq_len, num_heads, head_dim)
-        X = rearrange(X, "b h l d -> b l h d")
+        X = tf.transpose(X, perm=(0, 2, 1, 3))
 
         # concatenate num_heads dimension with head_dim dimension:
-        X = rearrange(X, "b l h d -> b l (h d)")
-        return X
+        depth = X.shape[-1] * X.shape[-2] if X.shape[-1] is not None and X.shape[-2] is not None else -1
+        return tf.reshape(X, shape=(tf.shape(X)[0], tf.shape(X)[1], depth))
+
+    def quantize(self, mode=None, **kwargs):
+        """Quantize the weights of the Q/K/V and output projections.
+
+        With ``mode="int8"`` the kernels are stored as int8 with one float32 scale per output unit (dynamic-range
+        quantization), which cuts their memory footprint by 4x. The inputs of the projections are then quantized per
+        row on the fly, and the projections run as int8 matmuls with int32 accumulation. This is meant for inference
+        and should be called once the layer is built. Quantizing a model (``model.quantize("int8")``) has the same
+        effect on this layer.
+
+        Parameters
+        ----------
+        mode : str
+            The quantization mode, only "int8" is supported.
+
+        Raises
+        ------
+        ValueError
+            If the quantization mode is not supported.
+        """
+        _check_quantization_mode(mode)
+        projections = [self.W_qkv] if self.fused_qkv else [self.W_q, self.W_k, self.W_v]
+        for layer in projections + [self.W_o]:
+            layer.quantize(mode, **kwargs)
+
+    def init_cache(self, batch_size, max_len, dtype=None):
+        """Return an empty fixed-capacity key-value cache to be passed as past_kv.
+
+        The cache holds up to max_len positions and is filled in place (see call), so decoding with it keeps the
+        same shapes at every step, unlike the (keys, values) cache which grows by concatenation.
+
+        Parameters
+        ----------
+        batch_size : int
+            The batch size.
+        max_len : int
+            The maximum number of key-value pairs the cache can hold.
+        dtype : tf.DType, optional
+            The dtype of the cached keys and values, by default the compute dtype of the layer.
+
+        Returns
+        -------
+        Tuple[tf.Tensor, tf.Tensor, tf.Tensor]
+            The zero keys and values of shape (batch_size, num_heads, max_len, depth / num_heads), and the number
+            of cached key-value pairs (0).
+        """
+        shape = (batch_size, self.num_heads, max_len, self.head_dim)
+        dtype = dtype or self.compute_dtype
+        return tf.zeros(shape, dtype=dtype), tf.zeros(shape, dtype=dtype), tf.constant(0, dtype=tf.int32)
 
     def call(
         self,
@@ -244,6 +520,9 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         keys: tf.Tensor,
         values: tf.Tensor,
         attention_mask: tf.Tensor = None,
+        past_kv=None,
+        use_cache: bool = False,
+        training=None,
         **kwargs,
     ) -> tf.Tensor:
         """Compute the multi-head attention for the given queries, keys, and values.
@@ -253,8 +532,8 @@ class MultiHeadAttention(tf.keras.layers.Layer):
             in the constructor. The attention scores are then combined and transformed to produce
             the final output of the layer.
 
-            The method optionally accepts a window mask, which is used to prevent attention
-            between elements that are too far apart in the input sequence. This can help the model
+            The method optionally accepts an attention mask (the valid lengths of the keys or a window mask), which is
+            used to prevent attention to padding or between elements that are too far apart in the input sequence. This can help the model
             to focus on local contexts and avoid attending to irrelevant positions in the input.
 
             The method returns the final output tensor and an optional tensor containing the
@@ -269,20 +548,35 @@ class MultiHeadAttention(tf.keras.layers.Layer):
             The keys tensor. This tensor has shape (batch_size, no. of key-value pairs, depth).
         values : tf.Tensor
             The values tensor. This tensor has shape (batch_size, no. of key-value pairs, depth).
-        valid_lens : Union[tf.Tensor, tf.Tensor]
-            The valid sequence lengths for the queries and keys. This tensor has shape
-            (batch_size,) or (batch_size, no. of queries).
-        window_mask : Optional[tf.Tensor], optional
-            The window mask tensor, by default None. This tensor has shape
-            (batch_size, no. of queries, no. of key-value pairs) and contains zeros
-            for positions that should not attend to each other.
+        attention_mask : Optional[tf.Tensor], optional
+            The attention mask, by default None. Either the valid lengths of the keys with shape (batch_size,)
+            (only the first valid_lens[i] keys of the i-th sequence are attended to), or a keep mask of shape
+            (batch_size, no. of key-value pairs) or (batch_size, no. of queries, no. of key-value pairs) whose
+            nonzero (True) entries are attended to and zero (False) entries are masked out. The mask is broadcast
+            across the heads. With past_kv, the key-value pairs include the cached ones.
+        past_kv : Optional[Tuple[tf.Tensor, ...]], optional
+            The already projected keys and values of the previous steps, by default None. Each tensor has shape
+            (batch_size, num_heads, no. of cached key-value pairs, depth / num_heads). Only the given keys and
+            values (the new positions) are projected and appended to the cache, and the causal mask is shifted
+            so that the queries come right after the cached keys. If keys and values are None, the cache is used
+            as it is without any projection (e.g. the encoder outputs in cross-attention). Either a growing
+            (keys, values) cache, whose shapes change at every step so that a jit-compiled layer is retraced each
+            time, or a fixed-capacity (keys, values, length) cache from init_cache, where the new positions are
+            written at `length` and the slots past it are masked out.
+        use_cache : bool, optional
+            Whether to also return the projected keys and values (including the cached ones) to be passed as
+            past_kv on the next step, by default False. A fixed-capacity cache is returned with its new length.
+        training : bool, optional
+            Whether the layer is called in training mode (i.e. whether to apply the attention dropout), by default
+            None which is the same as False.
 
         Returns
         -------
         Tuple[tf.Tensor, Optional[tf.Tensor]]
             The final output tensor and the attention weights tensor. The output tensor has
             shape (batch_size, sequence_length, d_model), and the attention weights tensor has
-            shape (batch_size, num_heads, sequence_length, sequence_length).
+            shape (batch_size, num_heads, sequence_length, sequence_length). If use_cache is set, the tuple of the
+            projected keys and values is returned as the third element.
 
         Raises
         ------
@@ -296,7 +590,7 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         >>> queries = tf.random.normal([batch_size, no_of_queries, depth])
         >>> keys = tf.random.normal([batch_size, no_of_key_value_pairs, depth])
         >>> values = tf.random.normal([batch_size, no_of_key_value_pairs, depth])
-        >>> valid_lens = tf.random.uniform([batch_size], minval=0, maxval=no_of_queries, dtype=tf.int32)
+        >>> valid_lens = tf.random.uniform([batch_size], minval=1, maxval=no_of_key_value_pairs, dtype=tf.int32)
 
         >>> multihead_attn = MultiHeadAttention(d_model=depth, num_heads=num_heads, dropout_rate=dropout)
         >>> output, attention_weights = multihead_attn(queries, keys, values, valid_lens)
@@ -308,39 +602,164 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         >>> queries = tf.random.normal([batch_size, no_of_queries, depth])
         >>> keys = tf.random.normal([batch_size, no_of_key_value_pairs, depth])
         >>> values = tf.random.normal([batch_size, no_of_key_value_pairs, depth])
-        >>> valid_lens = tf.random.uniform([batch_size], minval=0, maxval=no_of_queries, dtype=tf.int32)
         >>> window_mask = tf.random.uniform([batch_size, no_of_queries, no_of_key_value_pairs], 0, 2, dtype=tf.int32)
 
         >>> multihead_attn = MultiHeadAttention(d_model=depth, num_heads=num_heads, dropout_rate=dropout)
-        >>> output, attention_weights = multihead_attn(queries, keys, values, valid_lens, window_mask)
+        >>> output, attention_weights = multihead_attn(queries, keys, values, attention_mask=window_mask)
         """
 
+        # The identity of the inputs is checked here since it is lost once they are traced as separate arguments
+        self_attention = queries is keys and keys is values
+        shared_kv = keys is not None and keys is values
+        # training is passed on as a python bool so that, under jit_compile, the training and inference modes are
+        # traced (and compiled) separately rather than the first traced mode being baked in
+        if training is None or isinstance(training, bool):
+            training = bool(training)
+        outputs = self._call(
+            queries,
+            keys,
+            values,
+            attention_mask,
+            self_attention,
+            shared_kv,
+            past_kv,
+            use_cache,
+            training=training,
+            **kwargs,
+        )
+        # the attention layer only sees symbolic tensors while _call is traced, so the weights are stored from here
+        self.attention.attention_weights = outputs[1]
+        return outputs
+
+    def _project(self, X, index):
+        """Project X with the query (0), key (1), or value (2) projection and split it into heads."""
+        if self.fused_qkv:
+            if not self.W_qkv.built:
+                self.W_qkv.build(X.shape)
+            kernel, kernel_scale = _dense_kernel(self.W_qkv)
+            kernel = tf.split(kernel, 3, axis=-1)[index]
+            kernel_scale = tf.split(kernel_scale, 3)[index] if kernel_scale is not None else None
+            bias = tf.split(self.W_qkv.bias, 3)[index] if self.use_bias else None
+        else:
+            W = (self.W_q, self.W_k, self.W_v)[index]
+            if not W.built:
+                W.build(X.shape)
+            (kernel, kernel_scale), bias = _dense_kernel(W), W.bias
+        return self.project_heads(X, kernel, bias, kernel_scale)
+
+    def _call(
+        self,
+        queries,
+        keys,
+        values,
+        attention_mask,
+        self_attention,
+        shared_kv,
+        past_kv=None,
+        use_cache=False,
+        training=None,
+        **kwargs,
+    ):
+        if self_attention:
+            keys = values = queries
+        elif shared_kv:
+            values = keys
+
         # Shape of queries, keys, or values:
         # (batch_size, no. of queries or key-value pairs, depth)
-        # Shape of attention_mask: (batch_size,) or (batch_size, no. of queries)
+        # Shape of attention_mask: (batch_size, no. of key-value pairs) or
+        # (batch_size, no. of queries, no. of key-value pairs)
         # After transposing, shape of output queries, keys, or values:
-        # (batch_size * num_heads, no. of queries or key-value pairs,
+        # (batch_size, num_heads, no. of queries or key-value pairs,
         # depth / num_heads)
 
-        queries = self.split_heads(self.W_q(queries))
-        keys = self.split_heads(self.W_k(keys))
-        values = self.split_heads(self.W_v(values))
+        # The projections write their output directly in the per-head layout (see project_heads), the Dense layers
+        # only hold the variables. When the keys and values are the same tensor (e.g. the encoder outputs in
+        # cross-attention), both are projected with a single GEMM against the stacked W_k and W_v kernels.
+        if self.fused_qkv and keys is not None:
+            queries, keys, values = self.fused_projections(queries, keys, values)
+        else:
+            queries = self._project(queries, 0)
+            if shared_kv:
+                keys, values = self._project_kv(keys)
+            elif keys is not None:
+                keys, values = self._project(keys, 1), self._project(values, 2)
+
+        query_offset = 0
+        cache_mask = None
+        if past_kv is not None and len(past_kv) == 3:
+            # Fixed-capacity cache (see init_cache): the new positions are written at the tensor `length`, so every
+            # decoding step has the same shapes and a jit-compiled layer is not retraced as the cache fills up
+            past_keys, past_values, length = past_kv
+            if keys is None:
+                keys, values = past_keys, past_values
+            else:
+                query_offset = length
+                num_new = tf.shape(keys)[2]
+                positions = tf.range(tf.shape(past_keys)[2])
+                new_positions = tf.clip_by_value(positions - length, 0, num_new - 1)
+                write = ((positions >= length) & (positions < length + num_new))[:, tf.newaxis]
+                keys = tf.where(write, tf.gather(keys, new_positions, axis=2), tf.cast(past_keys, dtype=keys.dtype))
+                values = tf.where(
+                    write, tf.gather(values, new_positions, axis=2), tf.cast(past_values, dtype=values.dtype)
+                )
+                length = length + num_new
+            # the unwritten slots of the cache are masked out
+            cache_mask = (tf.range(tf.shape(keys)[2]) < length)[tf.newaxis, tf.newaxis, tf.newaxis, :]
+        elif past_kv is not None:
+            # Only the new positions were projected above, the cached keys and values are reused as they are. The
+            # cache grows by concatenation, so under jit_compile every step is traced anew (use init_cache instead)
+            past_keys, past_values = past_kv
+            if keys is None:
+                keys, values = past_keys, past_values
+            else:
+                query_offset = past_keys.shape[2] if past_keys.shape[2] is not None else tf.shape(past_keys)[2]
+                keys = tf.concat([tf.cast(past_keys, dtype=keys.dtype), keys], axis=2)
+                values = tf.concat([tf.cast(past_values, dtype=values.dtype), values], axis=2)
 
         if attention_mask is not None:
-            # On axis 0, copy the first item (scalar or vector) for num_heads
-            # times, then copy the next item, and so on
-            attention_mask = tf.repeat(attention_mask, repeats=self.num_heads, axis=0)
-
-        # Shape of output: (batch_size * num_heads, no. of queries,
+            if len(attention_mask.shape) == 1:
+                # valid lengths (batch_size,) -> keep mask (batch_size, k_len)
+                attention_mask = tf.sequence_mask(attention_mask, tf.shape(keys)[2])
+            # Insert a head axis so the same mask is broadcast across all the heads rather than copied num_heads
+            # times: (batch_size, k_len) -> (batch_size, 1, 1, k_len) and
+            # (batch_size, q_len, k_len) -> (batch_size, 1, q_len, k_len)
+            if len(attention_mask.shape) == 2:
+                attention_mask = attention_mask[:, tf.newaxis, tf.newaxis, :]
+            elif len(attention_mask.shape) == 3:
+                attention_mask = attention_mask[:, tf.newaxis, :, :]
+        if cache_mask is not None:
+            if attention_mask is not None:
+                cache_mask = cache_mask & tf.cast(attention_mask, dtype=tf.bool)
+            attention_mask = cache_mask
+
+        # Shape of output: (batch_size, num_heads, no. of queries,
         # depth / num_heads)
-        # The reason that the 4d tensors are passed to the attention layer is to enable vectorization
-        # in the matmul(qk.T)
+        # The 4d tensors are passed to the attention layer as they are (rather than merging the heads into the batch
+        # axis) so that matmul(qk.T) maps to a single strided batched GEMM over batch_size * num_heads matrices
         attention_output, attention_weights = self.attention(
-            queries, keys, values, attention_mask, **kwargs
+            queries, keys, values, attention_mask, training=training, query_offset=query_offset, **kwargs
         )
 
-        # Shape of output_concat: (batch_size, no. of queries, depth)
-        output_concat = self.inverse_transpose_qkv(attention_output)
-        final_output = self.W_o(output_concat)
-
+        # Shape of final_output: (batch_size, no. of queries, depth)
+        # The heads are merged inside the output projection: W_o's kernel is viewed as (num_heads, head_dim, depth)
+        # and contracted over both the head and head_dim axes, which equals W_o(inverse_transpose_qkv(...)) without
+        # the transpose and reshape of the attention output.
+        if not self.W_o.built:
+            self.W_o.build((None, None, self.d_model))
+        W_o, W_o_scale = _dense_kernel(self.W_o)
+        if W_o_scale is not None:
+            final_output = _quantized_matmul(self.inverse_transpose_qkv(attention_output), W_o, W_o_scale)
+        else:
+            W_o = tf.reshape(
+                tf.cast(W_o, dtype=attention_output.dtype), (self.num_heads, self.head_dim, self.d_model)
+            )
+            final_output = tf.einsum("bhqd,hde->bqe", attention_output, W_o)
+        if self.use_bias:
+            final_output = final_output + tf.cast(self.W_o.bias, dtype=final_output.dtype)
+
+        if use_cache:
+            if cache_mask is not None:
+                return final_output, attention_weights, (keys, values, length)
+            return final_output, attention_weights, (keys, values)
         return final_output, attention_weights
@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 import tensorflow as tf
 
@@ -69,13 +71,17 @@ class SinePositionalEncoding(tf.keras.layers.Layer):
         positions = tf.range(maximum_position_encoding, dtype=tf.float32)
         even_indices = tf.range(0, self.d_model, 2, dtype=tf.float32)
         odd_indices = tf.range(1, self.d_model, 2, dtype=tf.float32)
-        denominator = tf.pow(10000.0, tf.math.floor(even_indices / 2) / self.d_model)
-        even_encoding = tf.sin(positions[:, tf.newaxis] / denominator)
-        odd_encoding = tf.cos(positions[:, tf.newaxis] / denominator)
+        # 1 / 10000^(i / d_model) computed as exp(-i * log(10000) / d_model)
+        inverse_denominator = tf.exp(
+            tf.math.floor(even_indices / 2) * (-math.log(10000.0) / self.d_model)
+        )
+        angles = positions[:, tf.newaxis] * inverse_denominator
+        even_encoding = tf.sin(angles)
+        odd_encoding = tf.cos(angles)
         self.P = tf.concat([even_encoding, odd_encoding], axis=-1)[tf.newaxis, :, :]
 
     def call(self, x, **kwargs):
-        assert len(tf.shape(x)) == 3, f"Input must be a 3D tensor. Got {tf.shape(x)}"
+        assert x.shape.rank == 3, f"Input must be a 3D tensor. Got {x.shape}"
         if self.P.dtype != x.dtype:
             self.P = tf.cast(self.P, dtype=x.dtype)
         # self.P = tf.cast(self.P, dtype=X.dtype)
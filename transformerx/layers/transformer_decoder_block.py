@@ -130,6 +130,9 @@ class TransformerDecoderBlock(tf.keras.layers.Layer):
         Learning rate schedule function to be applied during training. If None, no learning rate schedule will be used.
     use_bias: bool (default=False)
         Whether to include bias terms in the computation of the self-attention weights.
+    fused_qkv: bool (default=False)
+        Whether to compute the query, key, and value projections of the self-attention layer with a single packed
+        projection (see :class:`MultiHeadAttention`).
     kernel_regularizer: Optional[tf.keras.regularizers.Regularizer] (default=None)
         Regularizer for the kernel weights of the AddNorm layer.
     bias_regularizer: Optional[tf.keras.regularizers.Regularizer] (default=None)
@@ -244,6 +247,7 @@ class TransformerDecoderBlock(tf.keras.layers.Layer):
             Callable
         ] = None,  # Learning rate schedule function
         use_bias: bool = False,  # Whether to include bias terms in the attention computation
+        fused_qkv: bool = False,  # Whether to pack the self-attention Q/K/V projections into one
         contextualized_embeddings=None,  # incorporate pre-trained language models such as BERT or GPT-2 into the
         # model (feedforward networks)
         causal_mask: bool = True,  # Whether to use a causal mask
@@ -268,6 +272,7 @@ class TransformerDecoderBlock(tf.keras.layers.Layer):
             use_bias=self.use_bias,
             attention=self.attention_mechanism,
             causal_mask=causal_mask,
+            fused_qkv=fused_qkv,
             **kwargs,
         )
         self.addnorm1 = (
@@ -66,7 +66,7 @@ class TransformerEncoder(tf.keras.layers.Layer):
 
     >>> # Compute the output representation for a batch of input sequences
     >>> input_sequences = tf.random.uniform((batch_size, seq_length))
-    >>> valid_lens = tf.random.uniform((batch_size,))
+    >>> valid_lens = tf.random.uniform((batch_size,), minval=1, maxval=seq_length, dtype=tf.int32)
     >>> output_representation = transformer_encoder(input_sequences, valid_lens)
 
     >>> # Get the attention weights of the TransformerEncoderBlock blocks
@@ -189,7 +189,8 @@ class TransformerEncoder(tf.keras.layers.Layer):
         queries : tf.Tensor
             The input sequence tensor of shape (batch_size, seq_length).
         attention_mask : tf.Tensor
-            The tensor of valid sequence lengths of shape (batch_size,) or (batch_size, seq_length).
+            Either the valid sequence lengths of shape (batch_size,), or a keep mask of shape (batch_size, seq_length)
+            or (batch_size, seq_length, seq_length) whose nonzero (True) entries are attended to.
         **kwargs : dict
             Additional keyword arguments to be passed to the TransformerEncoderBlock blocks.
 
@@ -215,8 +216,8 @@ class TransformerEncoder(tf.keras.layers.Layer):
         >>>
         >>> # Compute the output representation for a batch of input sequences
         >>> input_sequences = tf.random.uniform((batch_size, seq_length))
-        >>> valid_lens = tf.random.uniform((batch_size,))
-        >>> output_representation = transformer_encoder(input_sequences, attention_mask)
+        >>> valid_lens = tf.random.uniform((batch_size,), minval=1, maxval=seq_length, dtype=tf.int32)
+        >>> output_representation = transformer_encoder(input_sequences, valid_lens)
         >>>
         >>> # Get the attention weights of the TransformerEncoderBlock blocks
         >>> attention_weights = transformer_encoder.attention_weights
@@ -100,6 +100,9 @@ class TransformerEncoderBlock(tf.keras.layers.Layer):
         Learning rate schedule function to be applied during training. If None, no learning rate schedule will be used.
     use_bias: bool (default=False)
         Whether to include bias terms in the computation of the self-attention weights.
+    fused_qkv: bool (default=False)
+        Whether to compute the query, key, and value projections of the self-attention layer with a single packed
+        projection (see :class:`MultiHeadAttention`).
     kernel_regularizer: Optional[tf.keras.regularizers.Regularizer] (default=None)
         Regularizer for the kernel weights of the AddNorm layer.
     bias_regularizer: Optional[tf.keras.regularizers.Regularizer] (default=None)
@@ -222,6 +225,7 @@ class TransformerEncoderBlock(tf.keras.layers.Layer):
             Callable
         ] = None,  # Learning rate schedule function
         use_bias: bool = False,  # Whether to include bias terms in the attention computation
+        fused_qkv: bool = False,  # Whether to pack the self-attention Q/K/V projections into one
         contextualized_embeddings: bool = None,
         # incorporate pre-trained language models such as BERT or GPT-2 into the model (feedforward networks)
         name: str = "transformer_encoder_block",
@@ -275,7 +279,13 @@ class TransformerEncoderBlock(tf.keras.layers.Layer):
 
         self.d_model = d_model
         self.attention = MultiHeadAttention(
-            d_model, num_heads, dropout_rate, use_bias, attention_mechanism, **kwargs
+            d_model,
+            num_heads,
+            dropout_rate,
+            use_bias,
+            attention_mechanism,
+            fused_qkv=fused_qkv,
+            **kwargs,
         )
         self.addnorm1 = (
             AddNorm(
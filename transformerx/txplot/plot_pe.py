@@ -18,19 +18,12 @@ class Plot:
         lines = ["-", "--", "-.", ":"]
         self.line_cycler = cycle(lines)
 
-        def plot_line(col):
-            plt.plot(
-                    np.arange(num_steps),
-                    pos_encodings[0, :, col].T,
-                    next(self.line_cycler),
-                    label=f"col {col}",
-            )
-
-        if isinstance(cols, (list, np.ndarray)):
-            for col in cols:
-                plot_line(col)
-        else:
-            plot_line(cols)
+        # plot all the columns with a single call (one line per column) rather than one call per column
+        cols = np.atleast_1d(cols)
+        plotted_lines = plt.plot(np.arange(num_steps), np.asarray(pos_encodings)[0, :, cols].T)
+        for line, col in zip(plotted_lines, cols):
+            line.set_linestyle(next(self.line_cycler))
+            line.set_label(f"col {col}")
         ax.legend()
         plt.title("Columns 7-10")
         plt.grid(show_grid)
@@ -18,10 +18,8 @@ def sequence_mask(X, attention_mask, value=-1e9):
         mask = tf.range(start=0, limit=maxlen, dtype=tf.float32)[None, :] < tf.cast(
             attention_mask, dtype=tf.float32
         )
-        print("mask.shape: ", mask.shape, attention_mask.shape, X.shape)
     else:
         maxlen = X.shape[0]
-        print("attention_mask.shape: ", attention_mask.shape, X.shape)
         mask = tf.range(start=0, limit=maxlen, dtype=tf.float32) < tf.cast(
             attention_mask, dtype=tf.float32
         )
@@ -32,26 +30,44 @@ def sequence_mask(X, attention_mask, value=-1e9):
     return tf.where(mask, X, value)
 
 
-def masked_softmax(X, attention_mask, temperature=1.0):
-    """Perform softmax operation by masking elements on the last axis."""
+def masked_softmax(X, attention_mask, temperature=1.0, value=-1e9):
+    """Perform softmax operation by masking elements on the last axis.
+
+    The valid lengths are turned into an additive bias (0 for valid positions and `value` otherwise) which is broadcast
+    against `X` and added to it right before a single softmax, so neither `X` nor the mask is ever reshaped or tiled.
+
+    Parameters
+    ----------
+    X : tf.Tensor
+        Scores of shape (batch_size, no. of queries, no. of key-value pairs) or (batch_size, num_heads, no. of
+        queries, no. of key-value pairs).
+    attention_mask : tf.Tensor or tf.SparseTensor
+        Valid lengths of shape (batch_size,) or (batch_size, no. of queries).
+    temperature : float
+        Softmax temperature.
+    value : float
+        Additive bias of the masked positions, whose exponentiation outputs 0.
+
+    Returns
+    -------
+    output : tf.Tensor
+        Softmax of `X` over the last axis with the same shape as `X`.
+    """
 
-    # x: 3D tensor, attention_mask: 1D or 2D tensor
     if attention_mask is None:
         return tf.nn.softmax(X / temperature, axis=-1)
-    else:
-        shape = X.shape
-        if isinstance(attention_mask, tf.SparseTensor):
-            attention_mask = tf.sparse.reshape(attention_mask, shape=(-1,))
-        elif len(attention_mask.shape) == 1:
-            attention_mask = tf.repeat(attention_mask, repeats=shape[1])
-        else:
-            attention_mask = tf.reshape(attention_mask, shape=-1)
-        # On the last axis, replace masked elements with a very large negative
-        # value, whose exponentiation outputs 0
-        X = sequence_mask(
-            tf.reshape(X, shape=(-1, shape[-1])), attention_mask, value=1e-7
-        )
-        return tf.nn.softmax(tf.reshape(X, shape=shape) / temperature, axis=-1)
+
+    if isinstance(attention_mask, tf.SparseTensor):
+        attention_mask = tf.sparse.to_dense(attention_mask)
+    valid_lens = tf.cast(attention_mask, dtype=X.dtype)
+    if len(valid_lens.shape) == 1:
+        valid_lens = valid_lens[:, tf.newaxis]
+    # (batch_size, no. of queries) -> (batch_size, 1, ..., no. of queries, 1) so it broadcasts against X
+    while len(valid_lens.shape) < len(X.shape) - 1:
+        valid_lens = tf.expand_dims(valid_lens, axis=1)
+    mask = tf.range(tf.shape(X)[-1], dtype=X.dtype) < valid_lens[..., tf.newaxis]
+    bias = tf.where(mask, tf.zeros([], dtype=X.dtype), tf.cast(value, dtype=X.dtype))
+    return tf.nn.softmax((X + bias) / temperature, axis=-1)
 
 
 def use_device(device):